@@ -1,5 +1,6 @@
 import argparse
 import json
+import sys
 
 import pdfutils
 import nameutils
@@ -16,6 +17,9 @@ arg_parser.add_argument('input_pdf', type=str, help='Filename of input pdf')
 arg_parser.add_argument('output_pdf', type=str, help='Filename of output pdf')
 arg_parser.add_argument('--read_config', type=str, default=None, help='Input from config json (dict old -> new)')
 arg_parser.add_argument('--write_config', type=str, default=None, help='Output to config json (dict old -> new)')
+arg_parser.add_argument('--read_plan', type=str, default=None, help='Input from replacement plan json (see --write_plan)')
+arg_parser.add_argument('--write_plan', type=str, default=None, help='Output precompiled replacement plan json, reusable across documents')
+arg_parser.add_argument('--cache', type=str, default=None, help='Cache json of names found on each page and answers given, to only rescan changed pages on re-runs')
 arg_parser.add_argument('--race', type=str, default=None, help='Race of suggested names. Default is random.')
 args = arg_parser.parse_args()
 
@@ -25,23 +29,47 @@ pdfutils.unlock_pdf(args.input_pdf, tmp_pdf)
 
 # Read the document
 document = pdfutils.read_document(tmp_pdf)
-text_layer = pdfutils.build_text_layer(document)
-text = ''.join([t.value for t in text_layer[0]])
+text_tokens, page_tokens, fontcache = pdfutils.build_text_layer(document)
+text = ''.join([t.value for t in text_tokens])
 
-if args.read_config:
+if args.read_plan:
+    # If a plan file is passed, it already holds the precompiled replacements
+    plan = nameutils.read_plan(args.read_plan)
+elif args.read_config:
     # If a config file is passed, just read that instead of suggesting names
     with open(args.read_config, 'r') as f:
         obj = json.load(f)
     confirmed = {nameutils.tuplify(a): nameutils.tuplify(b) for a, b in obj.items()}
 else:
     # Find the names
-    names = nameutils.find_names(text)
+    if args.cache:
+        # If a cache file is passed, only scan the pages that changed since the last run
+        cache = nameutils.read_cache(args.cache)
+        page_texts = pdfutils.get_page_texts(document, text_tokens)
+        page_hashes = pdfutils.get_page_hashes(document)
+        names = nameutils.find_names_incremental(page_texts, page_hashes, cache)
+    else:
+        cache = {}
+        names = nameutils.find_names(text)
 
-    # Suggest some names
+    # Reuse the answers from the last run for names already decided
+    # (None means the original name was kept)
+    decided = {nameutils.tuplify(a): b and nameutils.tuplify(b) for a, b in cache.get('decided', {}).items()}
+    confirmed = {old: new for old, new in decided.items() if old in names and new}
+    names = set(names) - set(decided)
+    # Don't suggest new names that were already given out
+    for new in confirmed.values():
+        nameutils.suggested_names_used += list(new)
+
+    # Suggest some names that fit in the space of the old ones
+    nameutils.set_glyph_widths(pdfutils.get_glyph_widths(text_tokens))
     suggested = nameutils.get_suggestions(names, args.race)
 
+    # Tell the user about names nothing fits in place of; they're kept
+    for old in names - set(suggested):
+        print('No name fits in place of {}, keeping it'.format(nameutils.stringify(old)))
+
     # Ask the user
-    confirmed = {}
     for old, new in suggested.items():
         response = input('{} [{}]: '.format(nameutils.stringify(old), nameutils.stringify(new)))
         if len(response) == 0:
@@ -49,6 +77,12 @@ else:
         elif ' ' in response:
             confirmed[old] = nameutils.tuplify(response)
         # If not, it's not a valid name and it's probably a `n`, so ignore it
+        decided[old] = confirmed.get(old)
+
+    # If a cache file is passed, remember the answers for the next run
+    if args.cache:
+        cache['decided'] = {nameutils.stringify(a): b and nameutils.stringify(b) for a, b in decided.items()}
+        nameutils.write_cache(cache, args.cache)
     
     # If a config file is passed, write to that file so it can be used later
     if args.write_config:
@@ -56,10 +90,21 @@ else:
         with open(args.write_config, 'w') as f:
             json.dump(obj, f)
 
+if not args.read_plan:
+    plan = nameutils.make_plan(confirmed)
+    # If a plan file is passed, write it so later runs can skip rebuilding it
+    if args.write_plan:
+        nameutils.write_plan(plan, args.write_plan)
+
 # Do the replacements
-replacements = nameutils.make_replacers(confirmed)
-pdfutils.update_text_layer(replacements, *text_layer)
-pdfutils.apply_updated_text(document, *text_layer)
+replacements = nameutils.plan_replacers(plan)
+pdfutils.update_text_layer(replacements, text_tokens, page_tokens)
+try:
+    pdfutils.apply_updated_text(document, text_tokens, page_tokens, fontcache)
+except ValueError as e:
+    # Some replacement text can't be written in the PDF's fonts
+    print(e, file=sys.stderr)
+    sys.exit(1)
 
 # Write the output
 pdfutils.write_document(document, args.output_pdf)
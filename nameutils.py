@@ -1,8 +1,8 @@
 import re
+import numpy as np
 import pandas as pd
 import json
 import random
-from functools import partial
 
 # Tzioumis, Konstantinos (2018) Demographic aspects of first names, Scientific Data, 5:180025 [dx.doi.org/10.1038/sdata.2018.25].
 firstnames=pd.read_csv('firstnames.csv')
@@ -45,6 +45,37 @@ def find_names(text):
     names = set([wp for wp in wordpairs if is_wordpair_name(wp)])
     return names
 
+def find_names_incremental(page_texts, page_hashes, cache):
+    # Only scan the pages whose content isn't in the cache from a previous run,
+    # and remember the names found on each page for the next one. Each page is
+    # scanned with the last word of the page before, so names split across a
+    # page break are found; that word has to match too for the cache to count.
+    cached_pages = {(page['hash'], page['previous']): page['names'] for page in cache.get('pages', [])}
+    pages = []
+    previous = ''
+    for text, page_hash in zip(page_texts, page_hashes):
+        names = cached_pages.get((page_hash, previous))
+        if names is None:
+            names = sorted(stringify(n) for n in find_names(previous + ' ' + text))
+        pages.append({'hash': page_hash, 'previous': previous, 'names': names})
+        words = text.split()
+        if words:
+            previous = words[-1]
+    cache['pages'] = pages
+
+    return set(tuplify(n) for page in pages for n in page['names'])
+
+def read_cache(filename):
+    try:
+        with open(filename, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def write_cache(cache, filename):
+    with open(filename, 'w') as f:
+        json.dump(cache, f)
+
 race_codes = [
     ('white', [r'white', r'european', r'caucasian'], 65),
     ('black', [r'black', r'african([\s\-]american)?'], 11),
@@ -61,59 +92,208 @@ def get_race_code(race):
             return race_code
     return '2prace'
 
-suggested_names_used = []
-def suggest_name(firstnamelen, surnamelen, race_code=None):
-    global suggested_names_used
-    # Choose valid lengths
-    valid_firstnames = firstnames.loc[(firstnames['name'].str.len() <= firstnamelen) & ~surnames['name'].isin(suggested_names_used)].copy()
-    valid_surnames = surnames.loc[(surnames['name'].str.len() <= surnamelen) & ~surnames['name'].isin(suggested_names_used)].copy()
+# Widths of the glyphs in Helvetica, in thousandths of an em, used to estimate
+# how wide a name renders when the PDF's own font metrics aren't known
+default_glyph_widths = {
+    'A': 667, 'B': 667, 'C': 722, 'D': 722, 'E': 667, 'F': 611, 'G': 778,
+    'H': 722, 'I': 278, 'J': 500, 'K': 667, 'L': 556, 'M': 833, 'N': 722,
+    'O': 778, 'P': 667, 'Q': 778, 'R': 722, 'S': 667, 'T': 611, 'U': 722,
+    'V': 667, 'W': 944, 'X': 667, 'Y': 667, 'Z': 611,
+    'a': 556, 'b': 556, 'c': 500, 'd': 556, 'e': 556, 'f': 278, 'g': 556,
+    'h': 556, 'i': 222, 'j': 222, 'k': 500, 'l': 222, 'm': 833, 'n': 556,
+    'o': 556, 'p': 556, 'q': 556, 'r': 333, 's': 500, 't': 278, 'u': 556,
+    'v': 500, 'w': 722, 'x': 500, 'y': 500, 'z': 500,
+    ' ': 278, '-': 333, "'": 191, '.': 278,
+}
+default_glyph_width = 556
+glyph_widths = default_glyph_widths
+missing_glyph_width = default_glyph_width
 
+def name_width(name):
+    return sum(glyph_widths.get(c, missing_glyph_width) for c in name)
+
+def build_name_index(table, race_code=None):
+    # Bucket the names by length, and sort each bucket by rendered width, so
+    # the names that fit are the start of a few buckets rather than a scan.
+    # Each bucket keeps the running total of its names' weights, so a name
+    # can be sampled from those slices directly. There's an index per race,
+    # holding only the names likely to be that race, weighted by how likely.
+    weights = table['count']
     if race_code is not None:
         pct_race = next(pct for code, patterns, pct in race_codes if code == race_code)
-        race_code = 'pct' + race_code
+        column = 'pct' + race_code
+        table = table.loc[table[column] / pct_race > 1]
+        weights = table['count'] * table[column]
+    names = table['name'].values
+    lengths = table['name'].str.len().values
+    widths = np.array([name_width(n) for n in names], dtype=float)
+    weights = weights.values.astype(float)
+
+    index = {}
+    for length in np.unique(lengths):
+        bucket = np.flatnonzero(lengths == length)
+        bucket = bucket[np.argsort(widths[bucket], kind='stable')]
+        index[length] = (names[bucket], widths[bucket], np.cumsum(weights[bucket]))
+    return index
+
+def sample_name(index, maxlen, maxwidth, used):
+    # The slice of each bucket that fits, and the total weight of each slice
+    slices = []
+    for length, (names, widths, cumweights) in index.items():
+        if length <= maxlen:
+            end = widths.searchsorted(maxwidth, side='right')
+            if end > 0 and cumweights[end - 1] > 0:
+                slices.append((names, cumweights, end))
+    if not slices:
+        # No name fits
+        return None
+    totals = np.cumsum([cumweights[end - 1] for names, cumweights, end in slices])
+
+    # Choose randomly based on weight, trying again if the name is used
+    for attempt in range(100):
+        r = random.random() * totals[-1]
+        i = min(totals.searchsorted(r, side='right'), len(slices) - 1)
+        names, cumweights, end = slices[i]
+        r -= totals[i - 1] if i > 0 else 0
+        name = names[min(cumweights.searchsorted(r, side='right'), end - 1)]
+        if name not in used:
+            return name
+
+    # Most of the names that fit are used, so choose from the rest directly
+    remaining = []
+    weights = []
+    for names, cumweights, end in slices:
+        for name, weight in zip(names[:end], np.diff(cumweights[:end], prepend=0)):
+            if weight > 0 and name not in used:
+                remaining.append(name)
+                weights.append(weight)
+    if not remaining:
+        return None
+    return random.choices(remaining, weights)[0]
 
-        # Make sure it is likely the right race
-        valid_firstnames = valid_firstnames.loc[valid_firstnames[race_code] / pct_race > 1]
-        valid_surnames = valid_surnames.loc[valid_surnames[race_code] / pct_race > 1]
-        
-        # Modify the weights based on pct of this race
-        valid_firstnames['count'] *= valid_firstnames[race_code]
-        valid_surnames['count'] *= valid_surnames[race_code]
+# The indexes depend on the glyph widths, so they're built on first use,
+# after any widths from the PDF have been set, once for each race
+name_indexes = {}
+def get_name_indexes(race_code=None):
+    if race_code not in name_indexes:
+        name_indexes[race_code] = (build_name_index(firstnames, race_code), build_name_index(surnames, race_code))
+    return name_indexes[race_code]
 
-    # Choose randomly based on count
-    firstname = valid_firstnames.sample(1, weights=valid_firstnames['count'])['name'].iloc[0]
-    surname = valid_surnames.sample(1, weights=valid_surnames['count'])['name'].iloc[0]
+def set_glyph_widths(widths):
+    # Use the widths of the glyphs in the PDF's fonts where they are known.
+    # Fonts are often subsetted to the glyphs the PDF uses, so fill in the
+    # rest from Helvetica, scaled to match the PDF font on the glyphs in both.
+    global glyph_widths, missing_glyph_width
+    common = [c for c in widths if c in default_glyph_widths]
+    if common:
+        scale = sum(widths[c] for c in common) / sum(default_glyph_widths[c] for c in common)
+    else:
+        scale = 1
+    glyph_widths = {c: w * scale for c, w in default_glyph_widths.items()}
+    glyph_widths.update(widths)
+    missing_glyph_width = default_glyph_width * scale
+    name_indexes.clear()
+
+suggested_names_used = []
+def suggest_name(firstnamelen, surnamelen, race_code=None, firstnamewidth=None, surnamewidth=None):
+    global suggested_names_used
+    # Choose valid lengths, and widths so the new name doesn't ruin the kerning
+    if firstnamewidth is None:
+        firstnamewidth = float('inf')
+    if surnamewidth is None:
+        surnamewidth = float('inf')
+    firstnames_index, surnames_index = get_name_indexes(race_code)
+    used = set(suggested_names_used)
+    firstname = sample_name(firstnames_index, firstnamelen, firstnamewidth, used)
+    surname = sample_name(surnames_index, surnamelen, surnamewidth, used | {firstname})
+    if firstname is None or surname is None:
+        # No name fits
+        return None
 
     suggested_names_used += [firstname, surname]
     return firstname, surname
 
 def get_suggestions(old_names, race=None):
-    return {old: suggest_name(len(old[0]), len(old[1]), get_race_code(race)) for old in old_names}
+    # Names that nothing fits in place of are left out
+    suggestions = {}
+    for old in old_names:
+        new = suggest_name(len(old[0]), len(old[1]), get_race_code(race), name_width(old[0]), name_width(old[1]))
+        if new is not None:
+            suggestions[old] = new
+    return suggestions
 
 def stringify(t):
     return "{} {}".format(t[0], t[1])
 def tuplify(s):
     return tuple(s.split())
 
-def case_insensitive_replacer(old, new):
-    return partial(re.sub, old, new, flags=re.IGNORECASE)
-def get_group(s):
-    return s.group()
-def compose(*fs):
-    def func(x):
-        result = x
-        for f in fs:
-            result = f(result)
-        return result
-    return func
-def make_replacers(names):
-    replacers = []
+def case_variants(old, new):
+    # Map all upper and all lower case forms of an old word to the same form
+    # of the new word, so replacements keep the casing of the document. Any
+    # other form (e.g. title case) gets the new word exactly as given, so
+    # names like DeShawn or McKenzie keep their capitals.
+    return {
+        old.upper(): new.upper(),
+        old.lower(): new.lower(),
+        old.title(): new,
+        old: new,
+    }
+
+def make_plan(names):
+    # A replacement plan is everything needed to do the replacements, in a
+    # form that can be written to json and reused without rebuilding it.
+    # Each old word maps to its case variants and the new word as given.
+    # Full names are looked up as a pair, so characters sharing a first name
+    # or surname each get their own new name. A first name or surname on its
+    # own that two characters share goes to whoever was confirmed first.
+    fullnames = {}
+    words = {}
+    alternatives = []
     for old, new in names.items():
-        # First in tuple is regex to match either full name, first name or last name
-        regex = re.compile('\s({}\s{}|{}|{})\s'.format(old[0],old[1],old[0],old[1]), flags=re.IGNORECASE)
-        # Second in tuple is a function to change either full name, first name or last name to corresponding new name
-        func = compose(get_group, case_insensitive_replacer(old[0], new[0]), case_insensitive_replacer(old[1], new[1]))
-        
-        replacers.append((regex, func))
-    return replacers
+        alternatives.append(r'{}\s+{}'.format(re.escape(old[0]), re.escape(old[1])))
+        pair = [[case_variants(old_word, new_word), new_word] for old_word, new_word in zip(old, new)]
+        fullnames.setdefault('{} {}'.format(old[0], old[1]).lower(), pair)
+        for old_word, replacement in zip(old, pair):
+            words.setdefault(old_word.lower(), replacement)
+    # Full names go first so they win over a first name or surname on its own,
+    # then longer words before shorter ones that might be a prefix of them
+    alternatives += [re.escape(w) for w in sorted(words, key=len, reverse=True)]
+    pattern = r'(?<=\s)(?:{})(?=\s)'.format('|'.join(alternatives)) if alternatives else r'(?!)'
+    return {
+        'pattern': pattern,
+        'fullnames': fullnames,
+        'words': words,
+    }
 
+def write_plan(plan, filename):
+    with open(filename, 'w') as f:
+        json.dump(plan, f)
+
+def read_plan(filename):
+    with open(filename, 'r') as f:
+        return json.load(f)
+
+word_regex = re.compile(r'\S+')
+def replace_word(word, replacement):
+    # Mixed case words (e.g. McDONALD) fall back to the new name as given
+    cases, new = replacement
+    return cases.get(word, new)
+
+def plan_replacers(plan):
+    # Compile the single pattern once; the replacement is then only dict
+    # lookups for each word in the match
+    regex = re.compile(plan['pattern'], flags=re.IGNORECASE)
+    fullnames = plan['fullnames']
+    words = plan['words']
+    def func(m):
+        text = m.group()
+        parts = text.split()
+        if len(parts) == 1:
+            return replace_word(text, words[text.lower()])
+        # Keep whatever whitespace separates the first name and surname
+        pair = iter(fullnames[' '.join(parts).lower()])
+        return word_regex.sub(lambda w: replace_word(w.group(), next(pair)), text)
+    return [(regex, func)]
+
+def make_replacers(names):
+    return plan_replacers(make_plan(names))
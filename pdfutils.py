@@ -1,8 +1,13 @@
 # Mostly copied from https://github.com/JoshData/pdf-redactor
 
+import re
 import sys
+import codecs
+import hashlib
 from datetime import datetime
 import subprocess
+from bisect import bisect_right
+from itertools import accumulate
 
 from pdfrw import PdfDict, PdfReader, PdfWriter
 
@@ -18,6 +23,22 @@ def write_document(document, filename):
     writer.trailer = document
     writer.write(filename)
 
+# Character codes we can't decode are kept as private use characters, U+E000
+# plus the byte, so text around them can be changed and still encode back to
+# the original bytes.
+UNDECODABLE_BASE = 0xE000
+
+def undecodable_errors(error):
+    if isinstance(error, UnicodeDecodeError):
+        undecodable = bytearray(error.object[error.start:error.end])
+        return "".join(chr(UNDECODABLE_BASE + b) for b in undecodable), error.end
+    chars = error.object[error.start:error.end]
+    if all(UNDECODABLE_BASE <= ord(c) < UNDECODABLE_BASE + 256 for c in chars):
+        return bytes(bytearray(ord(c) - UNDECODABLE_BASE for c in chars)), error.end
+    raise error
+
+codecs.register_error("undecodable", undecodable_errors)
+
 class InlineImage(PdfDict):
     def read_data(self, tokens):
         # "Unless the image uses ASCIIHexDecode or ASCII85Decode as one
@@ -164,8 +185,12 @@ def build_text_layer(document):
     class TextToken:
         value = None
         font = None
-        def __init__(self, value, font):
+        page = None
+        encoded = None
+        inserted = ""
+        def __init__(self, value, font, page):
             self.font = font
+            self.page = page
             self.raw_original_value = value
             self.original_value = toUnicode(value, font, fontcache)
             self.value = self.original_value
@@ -176,7 +201,10 @@ def build_text_layer(document):
                 return PdfString.from_bytes(self.raw_original_value)
             else:
                 # If the value changed, encode it from Unicode according to the encoding
-                # of the font that is active at the location of this token.
+                # of the font that is active at the location of this token
+                # (usually already done for all changed tokens by encode_updated_text).
+                if self.encoded is not None and self.encoded[0] == self.value:
+                    return PdfString.from_bytes(self.encoded[1])
                 return PdfString.from_bytes(fromUnicode(self.value, self.font, fontcache))
         def __repr__(self):
             # __repr__ is used for debugging
@@ -217,7 +245,7 @@ def build_text_layer(document):
 
         def make_mutable_string_token(token):
             if isinstance(token, PdfString):
-                token = TextToken(token.to_bytes(), current_font)
+                token = TextToken(token.to_bytes(), current_font, len(page_tokens) - 1)
 
                 # Remember all unicode characters seen in this font so we can
                 # avoid inserting characters that the PDF isn't likely to have
@@ -266,7 +294,66 @@ def build_text_layer(document):
             prev_prev_token = prev_token
             prev_token = token
 
-    return (text_tokens, page_tokens)
+    return (text_tokens, page_tokens, fontcache)
+
+
+def get_page_texts(document, text_tokens):
+    # Split the text content of the document back up by the page it's on.
+    page_texts = [[] for page in document.pages]
+    for token in text_tokens:
+        page_texts[token.page].append(token.value)
+    return ["".join(text) for text in page_texts]
+
+
+def get_page_hashes(document):
+    # Identify each page by a hash of its (uncompressed) content streams, so
+    # we can tell which pages changed between two versions of a document.
+    from pdfrw import PdfArray
+    from pdfrw.uncompress import uncompress as uncompress_streams
+    page_hashes = []
+    for page in document.pages:
+        page_hash = hashlib.sha1()
+        if page.Contents is not None:
+            if isinstance(page.Contents, PdfArray):
+                contents = list(page.Contents)
+            else:
+                contents = [page.Contents]
+            uncompress_streams(contents)
+            for content in contents:
+                page_hash.update(content.stream.encode("Latin-1"))
+        page_hashes.append(page_hash.hexdigest())
+    return page_hashes
+
+
+def get_glyph_widths(text_tokens):
+    # Simple fonts give the width of each glyph in their /Widths array, indexed
+    # by character code starting at /FirstChar, in thousandths of an em. Map
+    # those back to unicode characters so we can estimate how much room a
+    # replacement name takes up. Where fonts disagree, the most used one wins.
+    fonts = {}
+    usage = {}
+    for token in text_tokens:
+        if token.font is not None:
+            fonts[id(token.font)] = token.font
+            usage[id(token.font)] = usage.get(id(token.font), 0) + 1
+
+    fontcache = {}
+    widths = {}
+    for key in sorted(fonts, key=usage.get, reverse=True):
+        font = fonts[key]
+        if font.Widths is None or font.FirstChar is None:
+            # e.g. composite fonts, which keep their widths in the descendant font
+            continue
+        first_char = int(font.FirstChar)
+        for i, width in enumerate(font.Widths):
+            code = first_char + i
+            if code > 255: break
+            char = toUnicode(bytes(bytearray([code])), font, fontcache)
+            width = float(width)
+            # Subsetted fonts give unused glyphs a width of zero
+            if len(char) == 1 and char != "?" and width > 0:
+                widths.setdefault(char, width)
+    return widths
 
 
 def chunk_pairs(s):
@@ -285,6 +372,8 @@ class CMap(object):
         self.unicode_to_bytes = { }
         self.defns = { }
         self.usecmap = None
+        self._encode_table = None
+        self._encode_multi = None
 
         # Decompress the CMap stream & check that it's not compressed in a way
         # we can't understand.
@@ -416,14 +505,51 @@ class CMap(object):
                 ret.append( self.bytes_to_unicode[string[i:i+2]] )
                 i += 2
             else:
-                ret.append("?")
+                # no entry; keep the byte so it encodes back unchanged
+                ret.append( chr(UNDECODABLE_BASE + bytearray(string[i:i+1])[0]) )
                 i += 1
         return "".join(ret)
 
-    def encode(self, string):
+    def encode_table(self):
+        # A str.translate table from each character to its code, given as
+        # Latin-1 characters so that the translated string encodes straight
+        # to the code bytes, and a pattern that splits out the multi-character
+        # entries (ligatures like "fi") to look up first, longest first.
+        # Built once, on first use.
+        if self._encode_table is None:
+            self._encode_table = { ord(char): code.decode("Latin-1")
+                for char, code in self.unicode_to_bytes.items() if len(char) == 1 }
+            for b in range(256):
+                self._encode_table.setdefault(UNDECODABLE_BASE + b, chr(b))
+            multi = sorted((char for char in self.unicode_to_bytes if len(char) > 1), key=len, reverse=True)
+            if multi:
+                self._encode_multi = re.compile("(%s)" % "|".join(re.escape(char) for char in multi))
+        return self._encode_table
+
+    def split_multi(self, string):
+        # Alternating runs of single characters and multi-character entries.
+        self.encode_table()
+        if self._encode_multi is None:
+            return [string]
+        return self._encode_multi.split(string)
+
+    def unmappable(self, string):
+        table = self.encode_table()
+        chars = set("".join(self.split_multi(string)[::2]))
+        return sorted(c for c in chars if ord(c) not in table)
+
+    def encode(self, string, check=True):
+        if check:
+            missing = self.unmappable(string)
+            if missing:
+                raise ValueError("No character codes for %s in CMap." % "".join(missing))
+        table = self.encode_table()
         ret = []
-        for c in string:
-            ret.append(self.unicode_to_bytes.get(c, b""))
+        for i, part in enumerate(self.split_multi(string)):
+            if i % 2:
+                ret.append(self.unicode_to_bytes[part])
+            else:
+                ret.append(part.translate(table).encode("Latin-1"))
         return b"".join(ret)
 
 
@@ -449,48 +575,116 @@ def toUnicode(string, font, fontcache):
         #sys.stderr.write(string)
         return string
     elif font.Encoding == "/WinAnsiEncoding":
-        return string.decode("cp1252", "replace")
+        return string.decode("cp1252", "undecodable")
     elif font.Encoding == "/MacRomanEncoding":
-        return string.decode("mac_roman", "replace")
+        return string.decode("mac_roman", "undecodable")
     else:
         return "?"
         #raise ValueError("Don't know how to decode data from font %s." % font)
 
-def fromUnicode(string, font, fontcache):
-    # Encode the Unicode string in the same encoding that it was originally
-    # stored in --- based on the font that was active when the token was
-    # used in a text-showing operation.
+def get_encoder(font, fontcache):
+    # Work out how to encode Unicode strings in the same encoding that text was
+    # originally stored in --- based on the font that was active when the
+    # token was used in a text-showing operation. Returns a function that
+    # encodes a string, and a function that lists the characters of a string
+    # that can't be encoded (the first doesn't check them).
     if not font:
         # There was no font for this text. Assume Latin-1.
-        return string.encode("Latin-1")
+        codec = "Latin-1"
 
     elif font.ToUnicode and font.ToUnicode.stream in fontcache:
         # Convert the Unicode code points back to one/two-byte CIDs.
         cmap = fontcache[font.ToUnicode.stream]
-        return cmap.encode(string)
+        return (lambda string: cmap.encode(string, check=False)), cmap.unmappable
 
     # Convert using a simple encoding.
     elif font.Encoding == "/WinAnsiEncoding":
-        return string.encode("cp1252")
+        codec = "cp1252"
     elif font.Encoding == "/MacRomanEncoding":
-        return string.encode("mac_roman")
+        codec = "mac_roman"
 
     # Don't know how to handle this sort of font.
     else:
         raise ValueError("Don't know how to encode data to font %s." % font)
 
+    def encode(string):
+        return string.encode(codec, "undecodable")
+    def unmappable(string):
+        missing = []
+        for c in set(string):
+            try:
+                c.encode(codec, "undecodable")
+            except UnicodeEncodeError:
+                missing.append(c)
+        return sorted(missing)
+    return encode, unmappable
+
+def fromUnicode(string, font, fontcache):
+    encode, unmappable = get_encoder(font, fontcache)
+    missing = unmappable(string)
+    if missing:
+        raise ValueError("Can't encode %s in font %s." % (repr("".join(missing)), font.BaseFont if font else None))
+    return encode(string)
+
+def encode_updated_text(text_tokens, fontcache):
+    # Encode the tokens whose text changed, before any content is written.
+    # The changed tokens on each page are grouped by font, so the font's
+    # encoding is only resolved once and each group is checked in one go.
+    # Only the text the replacements put in is checked, since the rest came
+    # from the font and encodes back. Characters a font has no code for
+    # (and fonts we can't encode at all) are all reported up front, rather
+    # than corrupting the output.
+    groups = { }
+    for tok in text_tokens:
+        if tok.value != tok.original_value:
+            groups.setdefault((tok.page, id(tok.font)), []).append(tok)
+
+    encoders = { }
+    errors = []
+    for (page, font_id), toks in groups.items():
+        font = toks[0].font
+        where = "on page %d in font %s" % (page + 1, font.BaseFont if font else None)
+        if font_id not in encoders:
+            try:
+                encoders[font_id] = get_encoder(font, fontcache)
+            except ValueError:
+                encoders[font_id] = None
+        if encoders[font_id] is None:
+            errors.append("unknown encoding " + where)
+            continue
+        encode, unmappable = encoders[font_id]
+
+        missing = unmappable("".join(tok.inserted for tok in toks))
+        if missing:
+            errors.append("%s %s" % (repr("".join(missing)), where))
+            continue
+
+        for tok in toks:
+            tok.encoded = (tok.value, encode(tok.value))
+
+    if errors:
+        raise ValueError("Can't encode replacement text:\n" + "\n".join("  " + e for e in errors))
+
 def update_text_layer(replacements, text_tokens, page_tokens):
     if len(text_tokens) == 0:
         # No text content.
         return
 
     # Apply each regular expression to the text content...
+    text_content = None
     for pattern, function in replacements:
+        if text_content is None:
+            # Index where each token's text begins in the text content, so the
+            # tokens behind a match can be found by binary search.
+            text_content = "".join(t.value for t in text_tokens)
+            token_offsets = [0]
+            token_offsets.extend(accumulate(len(t.value) for t in text_tokens))
+
+        # Collect the edits to make to each token, as (start, end, replacement)
+        # spans of the token's text content before any of them are made.
+        edits = { }
+
         # Finding all matches...
-        text_tokens_index = 0
-        text_tokens_charpos = 0
-        text_tokens_token_xdiff = 0
-        text_content = "".join(t.value for t in text_tokens)
         for m in pattern.finditer(text_content):
             # We got a match at text_content[i1:i2].
             i1 = m.start()
@@ -499,31 +693,21 @@ def update_text_layer(replacements, text_tokens, page_tokens):
             # Pass the matched text to the replacement function to get replaced text.
             replacement = function(m)
 
-            # Do a text replacement in the tokens that produced this text content.
+            # Find the token in the content stream that produced the start of
+            # the matched text. (Tokens with no text share their offset with
+            # the next token, which this skips past.)
+            index = bisect_right(token_offsets, i1) - 1
+
             # It may have been produced by multiple tokens, so loop until we find them all.
-            while i1 < i2:
-                # Find the original tokens in the content stream that
-                # produced the matched text. Start by advancing over any
-                # tokens that are entirely before this span of text.
-                while text_tokens_index < len(text_tokens) and \
-                      text_tokens_charpos + len(text_tokens[text_tokens_index].value)-text_tokens_token_xdiff <= i1:
-                    text_tokens_charpos += len(text_tokens[text_tokens_index].value)-text_tokens_token_xdiff
-                    text_tokens_index += 1
-                    text_tokens_token_xdiff = 0
-                if text_tokens_index == len(text_tokens): break
-                assert(text_tokens_charpos <= i1)
-
-                # The token at text_tokens_index, and possibly subsequent ones,
-                # are responsible for this text. Replace the matched content
-                # here with replacement content.
-                tok = text_tokens[text_tokens_index]
+            while i1 < i2 and index < len(text_tokens):
+                tok = text_tokens[index]
 
                 # Where does this match begin within the token's text content?
-                mpos = i1 - text_tokens_charpos
+                mpos = i1 - token_offsets[index]
                 assert mpos >= 0
 
                 # How long is the match within this token?
-                mlen = min(i2-i1, len(tok.value)-text_tokens_token_xdiff-mpos)
+                mlen = min(i2-i1, len(tok.value)-mpos)
                 assert mlen >= 0
 
                 # How much should we replace here?
@@ -538,14 +722,35 @@ def update_text_layer(replacements, text_tokens, page_tokens):
                     r = replacement
                     replacement = None # sanity
 
-                # Do the replacement.
-                tok.value = tok.value[:mpos+text_tokens_token_xdiff] + r + tok.value[mpos+mlen+text_tokens_token_xdiff:]
-                text_tokens_token_xdiff += len(r) - mlen
+                edits.setdefault(index, []).append((mpos, mpos+mlen, r))
 
                 # Advance for next iteration.
                 i1 += mlen
+                index += 1
+
+        # Do the replacements, rebuilding each edited token's value once.
+        # Matches don't overlap and come in order, so neither do the edits.
+        for index, token_edits in edits.items():
+            tok = text_tokens[index]
+            pieces = []
+            pos = 0
+            for start, end, r in token_edits:
+                pieces.append(tok.value[pos:start])
+                pieces.append(r)
+                pos = end
+            pieces.append(tok.value[pos:])
+            tok.value = "".join(pieces)
+            # Remember what was put in, to check it can be encoded.
+            tok.inserted += "".join(r for start, end, r in token_edits)
+
+        # The next pattern has to see the replaced text.
+        if edits:
+            text_content = None
+
+def apply_updated_text(document, text_tokens, page_tokens, fontcache):
+    # Make sure all the changed text can be encoded before changing anything.
+    encode_updated_text(text_tokens, fontcache)
 
-def apply_updated_text(document, text_tokens, page_tokens):
     # Create a new content stream for each page by concatenating the
     # tokens in the page_tokens lists.
     from pdfrw import PdfArray